@@ -4,6 +4,7 @@ import plotly.express as px
 from plotly import graph_objects as go
 from pymongo import MongoClient
 import os
+from functools import partial
 from dotenv import load_dotenv
 
 # Load environment variables
@@ -12,31 +13,314 @@ mongo_uri = os.getenv("MONGO_URI")
 db_name = os.getenv("MONGO_DB")
 collection_name = os.getenv("MONGO_COLLECTION")
 
-# Load data from MongoDB
+# Wire compression, in order of preference
+MONGO_COMPRESSORS = "zstd,zlib"
+
+# Parquet snapshot written by the ETL; stale once a source file is newer
+PREPARED_PARQUET_PATH = "data/prepared.parquet"
+SOURCE_FILES = ["data/campaigns.json", "data/leads.json", "data/inscriptions.json"]
+
+# Small pre-aggregated collections written by the ETL
+CAMPAIGN_SUMMARY_COLLECTION = "campaign_summary"
+CHANNEL_SUMMARY_COLLECTION = "channel_summary"
+ANOMALY_SUMMARY_COLLECTION = "anomaly_summary"
+
+# Marker the ETL rewrites at the end of every run
+ETL_RUN_COLLECTION = "etl_run"
+
+# Low-cardinality columns the charts group on
+CATEGORY_COLUMNS = ["name", "input_channel", "conversion_anomaly_type"]
+
+# Modification time of the snapshot (None when missing or stale)
+def get_snapshot_mtime():
+    try:
+        snapshot_mtime = os.path.getmtime(PREPARED_PARQUET_PATH)
+    except FileNotFoundError:
+        return None
+    source_mtimes = [os.path.getmtime(path) for path in SOURCE_FILES if os.path.exists(path)]
+    if source_mtimes and snapshot_mtime < max(source_mtimes):
+        return None
+    return snapshot_mtime
+
+# Load data from the Parquet snapshot; keyed on its mtime, so a new ETL run
+# invalidates the cache
+@st.cache_data
+def load_data(snapshot_mtime):
+    if snapshot_mtime is None:
+        return None
+    # Dtypes are preserved in Parquet, no sanitization or date parsing needed
+    df = pd.read_parquet(PREPARED_PARQUET_PATH)
+    assert pd.api.types.is_datetime64_any_dtype(df["lead_created_at"]), \
+        "lead_created_at must be stored as a datetime column"
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype("category")
+    # Sorted DatetimeIndex so date filters are binary-searched slices
+    # (leads without a date can never match a date filter)
+    return (
+        df.dropna(subset=["lead_created_at"])
+        .set_index("lead_created_at")
+        .sort_index()
+    )
+
+# Box plot statistics per campaign (quartiles, 1.5 IQR whiskers, outliers), so
+# Plotly only receives a handful of values per box instead of every row
+def summarize_amounts(amounts_df):
+    rows = []
+    amounts = amounts_df.dropna(subset=["amount_float"])
+    for name, values in amounts.groupby("name", observed=True)["amount_float"]:
+        q1, median, q3 = values.quantile([0.25, 0.5, 0.75])
+        iqr = q3 - q1
+        inside = values.between(q1 - 1.5 * iqr, q3 + 1.5 * iqr)
+        rows.append({
+            "name": name,
+            "q1": q1,
+            "median": median,
+            "q3": q3,
+            "lowerfence": values[inside].min(),
+            "upperfence": values[inside].max(),
+            "outliers": values[~inside].tolist(),
+        })
+    return pd.DataFrame(
+        rows, columns=["name", "q1", "median", "q3", "lowerfence", "upperfence", "outliers"]
+    )
+
+# Without a snapshot, aggregations run server-side in MongoDB
+# One pooled client per server process, shared across reruns and sessions
+@st.cache_resource
+def get_client():
+    return MongoClient(
+        mongo_uri,
+        maxPoolSize=50,
+        compressors=MONGO_COMPRESSORS,
+        zlibCompressionLevel=6,
+    )
+
+def get_collection():
+    db = get_client()[db_name]
+    return db[collection_name]
+
+# Finish time of the last ETL run, read on every rerun; the cached Mongo queries
+# take it as their first argument, so they miss once the ETL uploads new data
+def get_etl_run():
+    db = get_client()[db_name]
+    etl_run = db[ETL_RUN_COLLECTION].find_one({}, {"_id": 0, "finished_at": 1})
+    return etl_run["finished_at"] if etl_run else None
+
+def build_match(campaigns, start_date, end_date):
+    return {
+        "name": {"$in": list(campaigns)},
+        "lead_created_at": {
+            "$gte": pd.Timestamp(start_date).to_pydatetime(),
+            "$lte": pd.Timestamp(end_date).to_pydatetime(),
+        },
+    }
+
+# Numerator condition: converted, and valid unless invalid conversions are included
+def converted_condition(include_invalid):
+    if include_invalid:
+        return "$converted"
+    return {"$and": ["$converted", "$conversion_valid"]}
+
+@st.cache_data
+def agg_filter_options(etl_run):
+    collection = get_collection()
+    names = [name for name in collection.distinct("name") if name is not None]
+    bounds = next(collection.aggregate([
+        {"$group": {
+            "_id": None,
+            "min_date": {"$min": "$lead_created_at"},
+            "max_date": {"$max": "$lead_created_at"},
+        }},
+    ]), {})
+    return names, bounds.get("min_date"), bounds.get("max_date")
+
+@st.cache_data
+def agg_metrics(etl_run, campaigns, start_date, end_date, include_invalid):
+    pipeline = [
+        {"$match": build_match(campaigns, start_date, end_date)},
+        {"$group": {
+            "_id": None,
+            "total_leads": {"$sum": 1},
+            "valid_conversions": {"$sum": {"$cond": ["$conversion_valid", 1, 0]}},
+            "invalid_conversions": {"$sum": {"$cond": [
+                {"$and": ["$converted", {"$eq": ["$conversion_valid", False]}]}, 1, 0
+            ]}},
+            "total_converted": {"$sum": {"$cond": [converted_condition(include_invalid), 1, 0]}},
+        }},
+    ]
+    empty = {"total_leads": 0, "valid_conversions": 0, "invalid_conversions": 0, "total_converted": 0}
+    return next(get_collection().aggregate(pipeline), empty)
+
+@st.cache_data
+def agg_conversions_by(etl_run, key, campaigns, start_date, end_date, include_invalid):
+    pipeline = [
+        {"$match": build_match(campaigns, start_date, end_date)},
+        {"$group": {
+            "_id": f"${key}",
+            "total_leads": {"$sum": 1},
+            "total_converted": {"$sum": {"$cond": [converted_condition(include_invalid), 1, 0]}},
+        }},
+        {"$project": {
+            "_id": 0,
+            key: "$_id",
+            "total_leads": 1,
+            "total_converted": 1,
+            "conversion_rate": {"$multiply": [{"$divide": ["$total_converted", "$total_leads"]}, 100]},
+        }},
+        {"$sort": {key: 1}},
+    ]
+    return pd.DataFrame(
+        list(get_collection().aggregate(pipeline)),
+        columns=[key, "total_leads", "total_converted", "conversion_rate"],
+    )
+
+@st.cache_data
+def agg_anomaly_counts(etl_run, campaigns, start_date, end_date):
+    match = build_match(campaigns, start_date, end_date)
+    match.update({"conversion_anomaly_type": {"$ne": "NO_ANOMALY"}, "converted": True})
+    pipeline = [
+        {"$match": match},
+        {"$group": {
+            "_id": {"name": "$name", "conversion_anomaly_type": "$conversion_anomaly_type"},
+            "count": {"$sum": 1},
+        }},
+        {"$project": {
+            "_id": 0,
+            "name": "$_id.name",
+            "conversion_anomaly_type": "$_id.conversion_anomaly_type",
+            "count": 1,
+        }},
+        {"$sort": {"name": 1, "conversion_anomaly_type": 1}},
+    ]
+    return pd.DataFrame(
+        list(get_collection().aggregate(pipeline)),
+        columns=["name", "conversion_anomaly_type", "count"],
+    )
+
+@st.cache_data
+def agg_amounts(etl_run, campaigns, start_date, end_date, include_invalid):
+    match = build_match(campaigns, start_date, end_date)
+    match["amount_float"] = {"$ne": None}
+    if not include_invalid:
+        match["conversion_valid"] = True
+    cursor = get_collection().find(match, {"_id": 0, "name": 1, "amount_float": 1})
+    return summarize_amounts(pd.DataFrame(list(cursor), columns=["name", "amount_float"]))
+
+# Over the full date range, the ETL summaries replace the raw aggregations
+@st.cache_data
+def load_summary(etl_run, summary_collection):
+    db = get_client()[db_name]
+    return pd.DataFrame(list(db[summary_collection].find({}, {"_id": 0})))
+
+def summary_for(etl_run, summary_collection, campaigns):
+    summary = load_summary(etl_run, summary_collection)
+    if summary.empty:
+        return summary
+    return summary[summary["name"].isin(campaigns)]
+
+def summary_metrics(etl_run, campaigns, start_date, end_date, include_invalid):
+    summary = summary_for(etl_run, CAMPAIGN_SUMMARY_COLLECTION, campaigns)
+    total_leads = int(summary["total_leads"].sum())
+    total_converted = int(summary["total_converted"].sum())
+    valid_converted = int(summary["valid_converted"].sum())
+    return {
+        "total_leads": total_leads,
+        "valid_conversions": valid_converted,
+        "invalid_conversions": total_converted - valid_converted,
+        "total_converted": total_converted if include_invalid else valid_converted,
+    }
+
+def summary_conversions_by(etl_run, key, campaigns, start_date, end_date, include_invalid):
+    summary_collection = CAMPAIGN_SUMMARY_COLLECTION if key == "name" else CHANNEL_SUMMARY_COLLECTION
+    summary = summary_for(etl_run, summary_collection, campaigns)
+    columns = [key, "total_leads", "total_converted", "conversion_rate"]
+    if summary.empty:
+        return pd.DataFrame(columns=columns)
+    converted_column = "total_converted" if include_invalid else "valid_converted"
+    return (
+        summary.groupby(key)
+        .agg(total_leads=("total_leads", "sum"), total_converted=(converted_column, "sum"))
+        .assign(conversion_rate=lambda d: d["total_converted"] / d["total_leads"] * 100)
+        .reset_index()
+    )[columns]
+
+def summary_anomaly_counts(etl_run, campaigns, start_date, end_date):
+    summary = summary_for(etl_run, ANOMALY_SUMMARY_COLLECTION, campaigns)
+    if summary.empty:
+        return pd.DataFrame(columns=["name", "conversion_anomaly_type", "count"])
+    return summary.sort_values(["name", "conversion_anomaly_type"])
+
+# With a snapshot, the same figures are computed in pandas from the filtered slice
+# (every function takes the snapshot mtime first, so a new snapshot misses the cache)
+@st.cache_data
+def filter_data(snapshot_mtime, campaigns, start_date, end_date):
+    df = load_data(snapshot_mtime)
+    filtered_df = df.loc[pd.Timestamp(start_date):pd.Timestamp(end_date)]
+    if set(campaigns) == set(df["name"].cat.categories):
+        # Every campaign selected: only leads without a campaign are left out
+        return filtered_df[filtered_df["name"].notna()]
+    return filtered_df[filtered_df["name"].isin(campaigns)]
+
+# Numerator flag: converted, and valid unless invalid conversions are included
+def counted_conversions(filtered_df, include_invalid):
+    return filtered_df["converted"] & (include_invalid | filtered_df["conversion_valid"])
+
+@st.cache_data
+def compute_metrics(snapshot_mtime, campaigns, start_date, end_date, include_invalid):
+    filtered_df = filter_data(snapshot_mtime, campaigns, start_date, end_date)
+    invalid = (filtered_df["conversion_valid"] == False) & (filtered_df["converted"] == True)
+    return {
+        "total_leads": len(filtered_df),
+        "valid_conversions": int(filtered_df["conversion_valid"].sum()),
+        "invalid_conversions": int(invalid.sum()),
+        "total_converted": int(counted_conversions(filtered_df, include_invalid).sum()),
+    }
+
 @st.cache_data
-def load_data():
-    client = MongoClient(mongo_uri)
-    db = client[db_name]
-    collection = db[collection_name]
-    data = list(collection.find())
-    df = pd.DataFrame(data)
-    return df
+def compute_conversions_by(snapshot_mtime, key, campaigns, start_date, end_date, include_invalid):
+    filtered_df = filter_data(snapshot_mtime, campaigns, start_date, end_date)
+    return (
+        filtered_df.assign(counted_conversion=counted_conversions(filtered_df, include_invalid))
+        .groupby(key, observed=True)
+        .agg(total_leads=("lead_id", "size"), total_converted=("counted_conversion", "sum"))
+        .assign(conversion_rate=lambda d: d["total_converted"] / d["total_leads"] * 100)
+        .reset_index()
+    )
+
+@st.cache_data
+def compute_anomaly_counts(snapshot_mtime, campaigns, start_date, end_date):
+    filtered_df = filter_data(snapshot_mtime, campaigns, start_date, end_date)
+    anomalies_df = filtered_df[
+        (filtered_df["conversion_anomaly_type"] != "NO_ANOMALY") &
+        (filtered_df["converted"] == True)
+    ]
+    return anomalies_df.groupby(
+        ["name", "conversion_anomaly_type"], observed=True
+    ).size().reset_index(name="count")
 
-# Load and sanitize data
-df = load_data()
+@st.cache_data
+def compute_amounts(snapshot_mtime, campaigns, start_date, end_date, include_invalid):
+    filtered_df = filter_data(snapshot_mtime, campaigns, start_date, end_date)
+    if not include_invalid:
+        filtered_df = filtered_df[filtered_df["conversion_valid"] == True]
+    return summarize_amounts(filtered_df[["name", "amount_float"]])
 
-# Convert ObjectId to string (to avoid pyarrow issues)
-if "_id" in df.columns:
-    df["_id"] = df["_id"].astype(str)
+# Load data
+snapshot_mtime = get_snapshot_mtime()
+df = load_data(snapshot_mtime)
 
-# Convert dates
-df["lead_created_at"] = pd.to_datetime(df["lead_created_at"], errors="coerce")
+if df is not None:
+    campaign_names = df["name"].dropna().unique().tolist()
+    min_date = df.index.min()
+    max_date = df.index.max()
+else:
+    etl_run = get_etl_run()
+    campaign_names, min_date, max_date = agg_filter_options(etl_run)
 
 # Title
 st.title("Panel de Conversión de Campañas")
 
 # Campaign filter
-campaign_names = df["name"].dropna().unique().tolist()
 selected_campaigns = st.multiselect(
     "Selecciona una o más campañas",
     options=campaign_names,
@@ -44,8 +328,6 @@ selected_campaigns = st.multiselect(
 )
 
 # Date filter
-min_date = df["lead_created_at"].min()
-max_date = df["lead_created_at"].max()
 start_date, end_date = st.date_input(
     "Selecciona un intervalo de fechas (fecha de creación del lead)",
     value=(min_date, max_date),
@@ -56,40 +338,64 @@ start_date, end_date = st.date_input(
 # Checkbox for including invalid conversions
 include_invalid = st.checkbox("Incluir conversiones inválidas en los gráficos", value=True)
 
-# Apply filters
-filtered_df = df[
-    (df["name"].isin(selected_campaigns)) &
-    (df["lead_created_at"] >= pd.to_datetime(start_date)) &
-    (df["lead_created_at"] <= pd.to_datetime(end_date))
-]
+if df is not None:
+    get_metrics = partial(compute_metrics, snapshot_mtime)
+    get_conversions_by = partial(compute_conversions_by, snapshot_mtime)
+    get_anomaly_counts = partial(compute_anomaly_counts, snapshot_mtime)
+    get_amounts = partial(compute_amounts, snapshot_mtime)
+elif (
+    min_date is not None
+    and start_date <= min_date.date()
+    and end_date >= max_date.date()
+    and not load_summary(etl_run, CAMPAIGN_SUMMARY_COLLECTION).empty
+):
+    # Full date range: read the pre-aggregated summaries
+    get_metrics = partial(summary_metrics, etl_run)
+    get_conversions_by = partial(summary_conversions_by, etl_run)
+    get_anomaly_counts = partial(summary_anomaly_counts, etl_run)
+    get_amounts = partial(agg_amounts, etl_run)
+else:
+    # Same figures, aggregated server-side
+    get_metrics = partial(agg_metrics, etl_run)
+    get_conversions_by = partial(agg_conversions_by, etl_run)
+    get_anomaly_counts = partial(agg_anomaly_counts, etl_run)
+    get_amounts = partial(agg_amounts, etl_run)
+
+# Cached per filter combination
+filter_args = (tuple(selected_campaigns), start_date, end_date)
+metrics = get_metrics(*filter_args, include_invalid)
+
+# Chart 5: Percentage of conversion by campaign
+conversion_rate_by_campaign = get_conversions_by("name", *filter_args, include_invalid)
+
+# Chart 1: Conversions by campaign name
+conversion_by_campaign = (
+    conversion_rate_by_campaign[conversion_rate_by_campaign["total_converted"] > 0]
+    [["name", "total_converted"]]
+    .rename(columns={"total_converted": "converted"})
+)
+
+# Chart 2: Distribution of amount paid by campaign
+amounts_summary = get_amounts(*filter_args, include_invalid)
 
-# Base and numerator for conversion calculation
-source_base_df = filtered_df.copy()
-source_numerator_df = filtered_df.copy()
-campaign_base_df = filtered_df.copy()
-campaign_numerator_df = filtered_df.copy()
+# Chart 3: Types of anomalies by campaign (always valid)
+anomaly_counts = get_anomaly_counts(*filter_args)
 
-if not include_invalid:
-    source_numerator_df = source_numerator_df[source_numerator_df["conversion_valid"] == True]
-    campaign_numerator_df = campaign_numerator_df[campaign_numerator_df["conversion_valid"] == True]
+# Chart 4: Conversion rate by campaign source (input_channel)
+source_conversion = None
+if df is None or "input_channel" in df.columns:
+    source_conversion = get_conversions_by("input_channel", *filter_args, include_invalid)
 
 # Metrics layout
 col1, col2, col3 = st.columns(3)
 with col1:
-    st.metric("Total de Leads", len(filtered_df))
+    st.metric("Total de Leads", metrics["total_leads"])
 with col2:
-    valid_conversions = filtered_df["conversion_valid"].sum()
-    st.metric("Conversiones Válidas", valid_conversions)
+    st.metric("Conversiones Válidas", metrics["valid_conversions"])
 with col3:
-    invalid_df = filtered_df[(filtered_df["conversion_valid"] == False) & (filtered_df["converted"] == True)]
-    st.metric("Conversiones Inválidas", len(invalid_df))
+    st.metric("Conversiones Inválidas", metrics["invalid_conversions"])
 
 # Chart 1: Conversions by campaign name
-conversion_by_campaign = (
-    campaign_numerator_df[campaign_numerator_df["converted"] == True]
-    .groupby("name")["converted"].count()
-    .reset_index(name="converted")
-)
 fig1 = px.bar(
     conversion_by_campaign,
     x="name",
@@ -100,23 +406,26 @@ fig1 = px.bar(
 st.plotly_chart(fig1, use_container_width=True)
 
 # Chart 2: Distribution of amount paid by campaign
-fig2 = px.box(
-    campaign_numerator_df,
-    x="name",
-    y="amount_float",
+fig2 = go.Figure(go.Box(
+    x=amounts_summary["name"],
+    q1=amounts_summary["q1"],
+    median=amounts_summary["median"],
+    q3=amounts_summary["q3"],
+    lowerfence=amounts_summary["lowerfence"],
+    upperfence=amounts_summary["upperfence"],
+    y=amounts_summary["outliers"].tolist(),
+    boxpoints="all",
+    jitter=0,
+    pointpos=0,
+))
+fig2.update_layout(
     title="Distribución de Monto Pagado por Campaña",
-    labels={"name": "Campaña", "amount_float": "Monto (€)"},
+    xaxis_title="Campaña",
+    yaxis_title="Monto (€)",
 )
 st.plotly_chart(fig2, use_container_width=True)
 
 # Chart 3: Types of anomalies by campaign (always valid)
-anomalies_df = filtered_df[
-    (filtered_df["conversion_anomaly_type"] != "NO_ANOMALY") &
-    (filtered_df["converted"] == True)
-]
-anomaly_counts = anomalies_df.groupby(
-    ["name", "conversion_anomaly_type"]
-).size().reset_index(name="count")
 fig3 = px.bar(
     anomaly_counts,
     x="name",
@@ -132,19 +441,7 @@ fig3 = px.bar(
 st.plotly_chart(fig3, use_container_width=True)
 
 # Chart 4: Conversion rate by campaign source (input_channel)
-if "input_channel" in df.columns:
-    source_conversion = (
-        source_base_df.groupby("input_channel")["lead_id"].count().reset_index(name="total_leads")
-        .merge(
-            source_numerator_df[source_numerator_df["converted"] == True]
-            .groupby("input_channel")["converted"].count().reset_index(name="total_converted"),
-            on="input_channel",
-            how="left"
-        )
-    )
-    source_conversion["conversion_rate"] = (
-        source_conversion["total_converted"] / source_conversion["total_leads"] * 100
-    )
+if source_conversion is not None:
     fig_source = px.bar(
         source_conversion,
         x="input_channel",
@@ -155,18 +452,6 @@ if "input_channel" in df.columns:
     st.plotly_chart(fig_source, use_container_width=True)
 
 # Chart 5: Percentage of conversion by campaign
-conversion_rate_by_campaign = (
-    campaign_base_df.groupby("name")["lead_id"].count().reset_index(name="total_leads")
-    .merge(
-        campaign_numerator_df[campaign_numerator_df["converted"] == True]
-        .groupby("name")["converted"].count().reset_index(name="total_converted"),
-        on="name",
-        how="left"
-    )
-)
-conversion_rate_by_campaign["conversion_rate"] = (
-    conversion_rate_by_campaign["total_converted"] / conversion_rate_by_campaign["total_leads"] * 100
-)
 fig_conv_pct = px.bar(
     conversion_rate_by_campaign,
     x="name",
@@ -177,11 +462,10 @@ fig_conv_pct = px.bar(
 st.plotly_chart(fig_conv_pct, use_container_width=True)
 
 # Funnel chart: conversion evolution
-converted_df = campaign_numerator_df[campaign_numerator_df["converted"] == True]
 funnel_fig = go.Figure(go.Funnel(
     y=["Leads", "Convertidos"],
-    x=[len(campaign_base_df), len(converted_df)],
+    x=[metrics["total_leads"], metrics["total_converted"]],
     textinfo="value+percent previous"
 ))
 funnel_fig.update_layout(title="Embudo de Conversión")
-st.plotly_chart(funnel_fig, use_container_width=True)
\ No newline at end of file
+st.plotly_chart(funnel_fig, use_container_width=True)
@@ -2,79 +2,135 @@
 ETL script for processing campaign, lead, and inscription data.
 
 This script loads data from local JSON files, cleans and enriches the dataset,
-detects anomalies in conversion records, and uploads the sanitized data to MongoDB.
+detects anomalies in conversion records, and uploads the prepared data to MongoDB.
 """
 
+import glob
+import hashlib
+import os
 import pandas as pd
 import numpy as np
+import orjson
+import polars as pl
+import pyarrow as pa
 from upload_to_mongo import upload_dataframe_to_mongo
 
+# Source files
+CAMPAIGNS_PATH = "data/campaigns.json"
+LEADS_PATH = "data/leads.json"
+INSCRIPTIONS_PATH = "data/inscriptions.json"
+SOURCE_FILES = [CAMPAIGNS_PATH, LEADS_PATH, INSCRIPTIONS_PATH]
 
-def parse_currency(euro_str):
-    """
-    Convert a European-style currency string to a float.
+# Prepared datasets cached by engine and by a content hash over the source
+# files and this module, so editing the preparation logic invalidates them
+PREPARED_CACHE_DIR = "data/.cache"
+
+# Low-cardinality string columns stored as categoricals
+CATEGORY_COLUMNS = ["campaign_id", "name", "input_channel"]
+
+# Possible values of conversion_anomaly_type
+ANOMALY_TYPES = ["NO_ANOMALY", "MISSING_INSCRIPTION_DATE", "NEGATIVE_CONVERSION_TIME"]
+
+# int64 representation of datetimes: nanoseconds per day and the NaT sentinel
+NANOSECONDS_PER_DAY = 86_400_000_000_000
+NAT_INT64 = np.iinfo(np.int64).min
+
+# Prepared dataset snapshot read by the dashboard
+PREPARED_PARQUET_PATH = "data/prepared.parquet"
+
+# Small pre-aggregated collections read by the dashboard
+CAMPAIGN_SUMMARY_COLLECTION = "campaign_summary"
+CHANNEL_SUMMARY_COLLECTION = "channel_summary"
+ANOMALY_SUMMARY_COLLECTION = "anomaly_summary"
+
+# Marker rewritten after every upload; the dashboard keys its Mongo caches on it
+ETL_RUN_COLLECTION = "etl_run"
+
+# Fields the dashboard filters and groups on in MongoDB
+DASHBOARD_INDEX_FIELDS = ["name", "lead_created_at", "input_channel", "conversion_anomaly_type"]
 
-    Handles currency strings such as "€1.234,56" and returns 1234.56.
+
+def source_files_key(paths=SOURCE_FILES):
+    """
+    Compute a short content hash over the given files.
 
     Args:
-        euro_str (str): The currency string.
+        paths (iterable of str): Files to hash, in order.
 
     Returns:
-        float or np.nan: Parsed float value or NaN if input is null.
-    """
-    if pd.isna(euro_str):
-        return np.nan
-    return float(
-        euro_str
-        .replace("€", "")
-        .replace("\xa0", "")
-        .replace(".", "")
-        .replace(",", ".")
-        .strip()
-    )
+        str: The first 12 hex digits of the SHA-256 over all files.
+    """
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()[:12]
 
 
-def load_data():
+def parse_currency_series(euro_series):
     """
-    Load campaign, lead, and inscription data from JSON files.
+    Convert a Series of European-style currency strings to floats.
+
+    Handles currency strings such as "€1.234,56" and returns 1234.56.
+
+    Args:
+        euro_series (pd.Series): The currency strings.
 
     Returns:
-        tuple: Three pandas DataFrames: (campaigns, leads, inscriptions)
+        pd.Series: Parsed float values, NaN where the input is null.
     """
-    campaigns = pd.read_json("data/campaigns.json")
-    leads = pd.read_json("data/leads.json")
-    inscriptions = pd.read_json("data/inscriptions.json")
-    return campaigns, leads, inscriptions
+    return pd.to_numeric(
+        euro_series
+        .str.replace("€", "", regex=False)
+        .str.replace("\xa0", "", regex=False)
+        .str.replace(".", "", regex=False)
+        .str.replace(",", ".", regex=False)
+        .str.strip(),
+        errors="coerce",
+    )
 
 
-def sanitize_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+def read_json_records(path, date_columns=()):
     """
-    Sanitizes a DataFrame for MongoDB insertion:
-    - Converts datetime64 columns to native Python datetime or None
-    - Replaces NaN/NaT with None for other data types
+    Read a JSON array of records into an Arrow-backed DataFrame.
+
+    Parses the file with orjson and builds the columns through a pyarrow Table,
+    skipping pandas' JSON parser and the intermediate object columns.
 
     Args:
-        df (pd.DataFrame): Input DataFrame to sanitize.
+        path (str): Path to the JSON file.
+        date_columns (iterable of str): Columns holding dates to convert to datetime64.
 
     Returns:
-        pd.DataFrame: A sanitized copy of the original DataFrame.
+        pd.DataFrame: The records, with Arrow-backed dtypes for non-date columns.
     """
-    df_sanitized = df.copy()
+    with open(path, "rb") as f:
+        records = orjson.loads(f.read())
+    # A struct array infers the schema from every record, not just the first
+    table = pa.Table.from_struct_array(pa.array(records))
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    for col in date_columns:
+        df[col] = pd.to_datetime(df[col].astype(object))
+    return df
 
-    # Process datetime columns
-    datetime_cols = df_sanitized.select_dtypes(include=["datetime64[ns]", "datetimetz"]).columns
-    for col in datetime_cols:
-        df_sanitized[col] = df_sanitized[col].astype(object).where(df_sanitized[col].notnull(), None)
 
-    # Replace other NaNs with None
-    df_sanitized = df_sanitized.where(pd.notnull(df_sanitized), None)
+def load_data():
+    """
+    Load campaign, lead, and inscription data from JSON files.
 
-    return df_sanitized
+    Returns:
+        tuple: Three pandas DataFrames: (campaigns, leads, inscriptions)
+    """
+    campaigns = read_json_records(CAMPAIGNS_PATH, date_columns=["started_at", "ended_at"])
+    leads = read_json_records(LEADS_PATH, date_columns=["created_at"])
+    inscriptions = read_json_records(INSCRIPTIONS_PATH, date_columns=["created_at"])
+    return campaigns, leads, inscriptions
 
 
-def detect_anomaly(row):
+def detect_anomalies(df):
     """
-    Detects the type of anomaly in a conversion record.
+    Detects the type of anomaly for every conversion record at once.
 
     Rules:
         - If inscription_created_at is missing and marked as converted → 'MISSING_INSCRIPTION_DATE'
@@ -82,16 +138,20 @@ def detect_anomaly(row):
         - Otherwise → 'NO_ANOMALY'
 
     Args:
-        row (pd.Series): A row from the merged dataset.
+        df (pd.DataFrame): The merged dataset with conversion columns computed.
 
     Returns:
-        str: Anomaly type.
+        pd.Categorical: Anomaly type for each row.
     """
-    if row["converted"] and pd.isna(row["inscription_created_at"]):
-        return "MISSING_INSCRIPTION_DATE"
-    if row["converted"] and row["conversion_time_days"] < 0:
-        return "NEGATIVE_CONVERSION_TIME"
-    return "NO_ANOMALY"
+    converted = df["converted"].to_numpy(dtype=bool)
+    conditions = [
+        converted & df["inscription_created_at"].isna().to_numpy(),
+        converted & (df["conversion_time_days"] < 0).to_numpy(dtype=bool),
+    ]
+    # Select category codes (indexes into ANOMALY_TYPES) rather than strings
+    choices = np.arange(1, len(ANOMALY_TYPES), dtype=np.int8)
+    codes = np.select(conditions, choices, default=np.int8(0)).astype(np.int8, copy=False)
+    return pd.Categorical.from_codes(codes, categories=ANOMALY_TYPES)
 
 
 def prepare_dataset(campaigns, leads, inscriptions):
@@ -129,33 +189,203 @@ def prepare_dataset(campaigns, leads, inscriptions):
     df["inscription_created_at"] = pd.to_datetime(df["created_at_insc"])
 
     # Convert monetary fields
-    df["cost_float"] = df["cost"].apply(parse_currency)
-    df["amount_float"] = df["amount"].apply(parse_currency)
+    df["cost_float"] = parse_currency_series(df["cost"])
+    df["amount_float"] = parse_currency_series(df["amount"])
 
-    # Calculate time to convert
-    df["conversion_time_days"] = (
-        df["inscription_created_at"] - df["lead_created_at"]
-    ).dt.days
+    # Calculate time to convert (whole days, floored) on the int64 nanosecond views
+    lead_ns = df["lead_created_at"].to_numpy(dtype="datetime64[ns]").view("i8")
+    inscription_ns = df["inscription_created_at"].to_numpy(dtype="datetime64[ns]").view("i8")
+    conversion_time_days = ((inscription_ns - lead_ns) // NANOSECONDS_PER_DAY).astype(np.float64)
+    conversion_time_days[(lead_ns == NAT_INT64) | (inscription_ns == NAT_INT64)] = np.nan
+    df["conversion_time_days"] = conversion_time_days
 
     # Flag: converted if there is an inscription
-    df["converted"] = ~df["inscription_created_at"].isna()
+    df["converted"] = inscription_ns != NAT_INT64
 
-    # Flag: valid conversion (i.e., inscription not before lead)
-    df["conversion_valid"] = df["conversion_time_days"] >= 0
+    # Flag: valid conversion (i.e., inscription not before lead; NaN compares False)
+    df["conversion_valid"] = conversion_time_days >= 0
 
     # Label anomaly types
-    df["conversion_anomaly_type"] = df.apply(detect_anomaly, axis=1)
+    df["conversion_anomaly_type"] = detect_anomalies(df)
+
+    # Back to NumPy-backed dtypes, the same ones the Polars engine produces
+    for col in df.columns:
+        if isinstance(df[col].dtype, pd.ArrowDtype):
+            df[col] = pa.array(df[col]).to_pandas().set_axis(df.index)
+
+    # Store low-cardinality labels as categoricals
+    for col in CATEGORY_COLUMNS:
+        df[col] = df[col].astype("category")
 
     return df
 
 
+def build_summaries(df):
+    """
+    Pre-aggregate the dataset for the dashboard's unfiltered-date views.
+
+    - campaign_summary: leads, conversions and median amount per campaign.
+    - channel_summary: the same counts per input channel and campaign, so the
+      dashboard can still apply its campaign filter.
+    - anomaly_summary: converted records with an anomaly, per campaign and type.
+
+    Leads without a creation date are left out, as they never match the
+    dashboard's date filter.
+
+    Args:
+        df (pd.DataFrame): The prepared dataset.
+
+    Returns:
+        dict: Collection name → summary DataFrame.
+    """
+    df = df[df["lead_created_at"].notna()]
+    conversion_aggs = dict(
+        total_leads=("lead_id", "size"),
+        total_converted=("converted", "sum"),
+        valid_converted=("conversion_valid", "sum"),
+    )
+    campaign_summary = (
+        df.groupby("name", observed=True)
+        .agg(**conversion_aggs, amount_median=("amount_float", "median"))
+        .reset_index()
+    )
+    channel_summary = (
+        df.groupby(["input_channel", "name"], observed=True)
+        .agg(**conversion_aggs)
+        .reset_index()
+    )
+    anomalies = df[df["converted"] & (df["conversion_anomaly_type"] != "NO_ANOMALY")]
+    anomaly_summary = (
+        anomalies.groupby(["name", "conversion_anomaly_type"], observed=True)
+        .size()
+        .reset_index(name="count")
+    )
+    return {
+        CAMPAIGN_SUMMARY_COLLECTION: campaign_summary,
+        CHANNEL_SUMMARY_COLLECTION: channel_summary,
+        ANOMALY_SUMMARY_COLLECTION: anomaly_summary,
+    }
+
+
+def parse_currency_expr(column):
+    """
+    Build a Polars expression converting European-style currency strings to floats.
+
+    Args:
+        column (str): Name of the currency column.
+
+    Returns:
+        pl.Expr: Expression yielding Float64 values, null where the input is null.
+    """
+    return (
+        pl.col(column)
+        .str.replace_all("€", "", literal=True)
+        .str.replace_all("\xa0", "", literal=True)
+        .str.replace_all(".", "", literal=True)
+        .str.replace_all(",", ".", literal=True)
+        .str.strip_chars()
+        .cast(pl.Float64, strict=False)
+    )
+
+
+def prepare_dataset_polars(
+    campaigns_path=CAMPAIGNS_PATH,
+    leads_path=LEADS_PATH,
+    inscriptions_path=INSCRIPTIONS_PATH,
+):
+    """
+    Polars implementation of load_data + prepare_dataset.
+
+    Builds the whole merge and enrichment as a single lazy query, so joins and
+    derived columns run in parallel and intermediate tables are never
+    materialized. Produces the same columns as prepare_dataset.
+
+    Args:
+        campaigns_path (str): Path to the campaigns JSON file.
+        leads_path (str): Path to the leads JSON file.
+        inscriptions_path (str): Path to the inscriptions JSON file.
+
+    Returns:
+        pd.DataFrame: Merged and enriched dataset ready for analysis.
+    """
+    # Source files are JSON arrays, not NDJSON, so read eagerly and go lazy
+    # (inferring the schema from every record, like read_json_records)
+    campaigns = pl.read_json(campaigns_path, infer_schema_length=None).lazy()
+    leads = pl.read_json(leads_path, infer_schema_length=None).lazy()
+    inscriptions = pl.read_json(inscriptions_path, infer_schema_length=None).lazy()
+
+    converted = pl.col("inscription_created_at").is_not_null()
+    df = (
+        leads
+        .join(
+            campaigns, left_on="input_channel", right_on="campaign_id",
+            how="left", coalesce=False, maintain_order="left",
+        )
+        .join(inscriptions, on="lead_id", how="left", suffix="_insc", maintain_order="left")
+        .with_columns(
+            pl.col(["created_at", "started_at", "ended_at", "created_at_insc"]).str.to_datetime("%Y-%m-%d"),
+        )
+        .with_columns(
+            pl.col("created_at").alias("lead_created_at"),
+            pl.col("created_at_insc").alias("inscription_created_at"),
+            parse_currency_expr("cost").alias("cost_float"),
+            parse_currency_expr("amount").alias("amount_float"),
+        )
+        .with_columns(
+            (pl.col("inscription_created_at") - pl.col("lead_created_at")).dt.total_days().alias("conversion_time_days"),
+            converted.alias("converted"),
+        )
+        .with_columns(
+            (pl.col("conversion_time_days") >= 0).fill_null(False).alias("conversion_valid"),
+            pl.when(converted & pl.col("inscription_created_at").is_null())
+            .then(pl.lit("MISSING_INSCRIPTION_DATE"))
+            .when(converted & (pl.col("conversion_time_days") < 0))
+            .then(pl.lit("NEGATIVE_CONVERSION_TIME"))
+            .otherwise(pl.lit("NO_ANOMALY"))
+            .cast(pl.Enum(ANOMALY_TYPES))
+            .alias("conversion_anomaly_type"),
+            pl.col(CATEGORY_COLUMNS).cast(pl.Categorical),
+        )
+        .collect()
+    )
+    return df.to_pandas()
+
+
 if __name__ == "__main__":
-    # Load data from JSON files
-    campaigns_df, leads_df, inscriptions_df = load_data()
-    # Prepare the merged dataset
-    merged_df = prepare_dataset(campaigns_df, leads_df, inscriptions_df)
-    # Sanitize DataFrame (convert datetime, replace NaN with None)
-    merged_df = sanitize_dataframe(merged_df)
-    # Upload to MongoDB using external module
-    upload_dataframe_to_mongo(merged_df)
+    engine = os.getenv("ETL_ENGINE", "pandas")
+    # Reuse the prepared dataset when neither the engine, this module nor the
+    # source files have changed
+    cache_key = source_files_key([*SOURCE_FILES, __file__])
+    cache_path = os.path.join(PREPARED_CACHE_DIR, f"prepared-{engine}-{cache_key}.parquet")
+    if os.path.exists(cache_path):
+        merged_df = pd.read_parquet(cache_path)
+    else:
+        if engine == "polars":
+            # Load and prepare the merged dataset in a single lazy query
+            merged_df = prepare_dataset_polars()
+        else:
+            # Load data from JSON files
+            campaigns_df, leads_df, inscriptions_df = load_data()
+            # Prepare the merged dataset
+            merged_df = prepare_dataset(campaigns_df, leads_df, inscriptions_df)
+        os.makedirs(PREPARED_CACHE_DIR, exist_ok=True)
+        merged_df.to_parquet(cache_path, compression="zstd")
+        # Drop the entries this one supersedes (same engine, older inputs)
+        for old_path in glob.glob(os.path.join(PREPARED_CACHE_DIR, f"prepared-{engine}-*.parquet")):
+            if old_path != cache_path:
+                os.remove(old_path)
+    # Save a Parquet snapshot for the dashboard
+    merged_df.to_parquet(PREPARED_PARQUET_PATH, compression="zstd")
+    # Upload to MongoDB using external module (missing values are written as null
+    # by the Arrow encoder, so no sanitizing is needed)
+    upload_dataframe_to_mongo(merged_df, index_fields=DASHBOARD_INDEX_FIELDS)
+    # Pre-aggregate and upload the dashboard summaries
+    for summary_collection, summary_df in build_summaries(merged_df).items():
+        upload_dataframe_to_mongo(summary_df, collection_name=summary_collection)
+    # Record the finished run, acknowledged so the marker is in place before we exit
+    upload_dataframe_to_mongo(
+        pd.DataFrame({"finished_at": [pd.Timestamp.now(tz="UTC")]}),
+        collection_name=ETL_RUN_COLLECTION,
+        write_concern_w=1,
+    )
     print("ETL completed and data uploaded to MongoDB Atlas")
\ No newline at end of file
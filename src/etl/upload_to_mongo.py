@@ -9,11 +9,57 @@ Usage:
 """
 
 import os
-from pymongo import MongoClient
+from functools import lru_cache
+import pyarrow as pa
+from pymongo import MongoClient, WriteConcern
+from pymongoarrow.api import write
 from dotenv import load_dotenv
 
+# Wire compression, in order of preference
+MONGO_COMPRESSORS = "zstd,zlib"
 
-def upload_dataframe_to_mongo(df, drop_existing=True):
+
+@lru_cache(maxsize=None)
+def get_client(mongo_uri):
+    """
+    Returns a MongoClient for the given URI, created once and reused afterwards.
+
+    Args:
+        mongo_uri (str): MongoDB connection string.
+
+    Returns:
+        MongoClient: A shared client with a warm connection pool.
+    """
+    return MongoClient(mongo_uri, compressors=MONGO_COMPRESSORS, zlibCompressionLevel=6)
+
+
+def dataframe_to_arrow(df):
+    """
+    Converts a DataFrame to an Arrow table that PyMongoArrow can encode.
+
+    Categorical columns become plain columns of their values, since BSON has
+    no dictionary-encoded type.
+
+    Args:
+        df (pd.DataFrame): The DataFrame to convert.
+
+    Returns:
+        pa.Table: The table, without the DataFrame index.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for i, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(i, field.name, table.column(i).cast(field.type.value_type))
+    return table
+
+
+def upload_dataframe_to_mongo(
+    df,
+    drop_existing=True,
+    index_fields=(),
+    write_concern_w=0,
+    collection_name=None,
+):
     """
     Uploads a pandas DataFrame to a MongoDB collection.
 
@@ -23,8 +69,12 @@ def upload_dataframe_to_mongo(df, drop_existing=True):
         MONGO_COLLECTION=your_collection
 
     Args:
-        df (pd.DataFrame): The DataFrame to upload. It should be pre-cleaned (no NaT, NaN).
+        df (pd.DataFrame): The DataFrame to upload. Missing values (NaN, NaT, None) are written as null.
         drop_existing (bool): If True, clears the existing collection before inserting.
+        index_fields (iterable of str): Fields to create ascending indexes on after inserting.
+        write_concern_w (int): Write concern for the inserts. The default 0 sends
+            unacknowledged writes, so the server does not report insert errors.
+        collection_name (str): Target collection. Defaults to MONGO_COLLECTION.
     
     Raises:
         ValueError: If environment variables are missing.
@@ -34,13 +84,13 @@ def upload_dataframe_to_mongo(df, drop_existing=True):
 
     mongo_uri = os.getenv("MONGO_URI")
     db_name = os.getenv("MONGO_DB")
-    collection_name = os.getenv("MONGO_COLLECTION")
+    collection_name = collection_name or os.getenv("MONGO_COLLECTION")
 
     if not mongo_uri or not db_name or not collection_name:
         raise ValueError("Missing MongoDB credentials or config in .env file.")
 
     # Connect to MongoDB
-    client = MongoClient(mongo_uri)
+    client = get_client(mongo_uri)
     db = client[db_name]
     collection = db[collection_name]
 
@@ -48,10 +98,20 @@ def upload_dataframe_to_mongo(df, drop_existing=True):
     if drop_existing:
         collection.delete_many({})
 
-    # Convert to records and insert
-    records = df.to_dict("records")
-    if records:
-        collection.insert_many(records)
-        print(f"Uploaded {len(records)} records to MongoDB → {db_name}.{collection_name}")
+    # PyMongoArrow still encodes one dict per row, but reads them from the Arrow
+    # table (no DataFrame.to_dict pass) and sends them in message-sized batches
+    insert_collection = collection.with_options(write_concern=WriteConcern(w=write_concern_w))
+    result = write(insert_collection, dataframe_to_arrow(df))
+    uploaded = result.raw_result["insertedCount"]
+
+    if not uploaded:
+        print("No records to upload.")
+    elif write_concern_w == 0:
+        # Unacknowledged: this counts what was sent, not what the server stored
+        print(f"Sent {uploaded} records to MongoDB → {db_name}.{collection_name}")
     else:
-        print("No records to upload.")
\ No newline at end of file
+        print(f"Uploaded {uploaded} records to MongoDB → {db_name}.{collection_name}")
+
+    # Index the fields used by server-side filters and aggregations
+    for field in index_fields:
+        collection.create_index(field)